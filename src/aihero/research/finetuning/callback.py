@@ -1,5 +1,4 @@
 """Custom callback for sampling from a LLM and reporting custom eval to WANDB."""
-import random
 from typing import Any
 
 from datasets import Dataset
@@ -22,8 +21,8 @@ class LLMSampleCB(WandbCallback):  # type: ignore
         num_samples: int = 100,
         max_new_tokens: int = MAX_NEW_TOKENS,
         log_model: str = "checkpoint",
-        run_tests_str: str = "",
-        run_metrics_str: str = "",
+        run_tests_path: str = "",
+        run_metrics_path: str = "",
     ):
         """Initialize the callback by extracting a few rows from the test split."""
         super().__init__()
@@ -33,24 +32,15 @@ class LLMSampleCB(WandbCallback):  # type: ignore
             model=trainer.model,
             tokenizer=trainer.tokenizer,
             task=task,
-            run_tests_str=run_tests_str,
-            run_metrics_str=run_metrics_str,
+            run_tests_path=run_tests_path,
+            run_metrics_path=run_metrics_path,
             max_new_tokens=max_new_tokens,
         )
 
         # Sample a few rows from the test split to generate a table of predictions
         # for visual inspection a.k.a. spot checking
-        # Randomly select indices for the samples
-        if num_samples >= test_split.num_rows:
-            selected_indices = list(range(0, test_split.num_rows))
-        else:
-            selected_indices = random.sample(range(test_split.num_rows), num_samples)
-        # Retrieve the selected samples from the dataset
-        test_split_list = list(test_split)
-        self.sample_split = []
-        for i in selected_indices:
-            self.sample_split.append(test_split_list[i])
-        self.sample_split = Dataset.from_list(self.sample_split)
+        # Shuffling only permutes an indices mapping, the rows themselves are not copied
+        self.sample_split = test_split.shuffle(seed=42).select(range(min(num_samples, test_split.num_rows)))
 
     def initialize(self: "LLMSampleCB") -> None:
         """Generate initial predictions for the sample split and log them to WANDB."""
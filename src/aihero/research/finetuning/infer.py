@@ -2,17 +2,22 @@
 import os
 from pathlib import Path
 from tempfile import TemporaryDirectory
-from typing import Any, Tuple
+from typing import Any, Callable, Optional, Tuple
 
 import torch
-from datasets import Dataset, DatasetDict, DatasetInfo
+from datasets import Dataset, DatasetDict, DatasetInfo, load_from_disk
 from huggingface_hub import login
 from tqdm import tqdm
 from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, GenerationConfig
 from wandb import Table, finish
 
 from aihero.research.config.schema import BatchInferenceJob
-from aihero.research.finetuning.utils import DatasetMover, dataset_generator
+from aihero.research.finetuning.utils import (
+    DatasetMover,
+    format_dataset_dict,
+    load_callable,
+    load_formatted_dataset,
+)
 
 CHECKPOINT_DIR = "/mnt/checkpoint"
 DATASET_DIR = "/mnt/dataset"
@@ -35,13 +40,13 @@ class BatchInferenceJobRunner:
 
         # Prep for eval
         if self.batch_inference_job.eval:
-            run_tests_str = self.batch_inference_job.eval.tests or ""
-            run_metrics_str = self.batch_inference_job.eval.metrics or ""
+            run_tests_path = self.batch_inference_job.eval.tests or ""
+            run_metrics_path = self.batch_inference_job.eval.metrics or ""
             size = self.batch_inference_job.size or 0
             randomize = self.batch_inference_job.randomize or False
         else:
-            run_tests_str = ""
-            run_metrics_str = ""
+            run_tests_path = ""
+            run_metrics_path = ""
             size = 0
             randomize = False
 
@@ -54,8 +59,8 @@ class BatchInferenceJobRunner:
                 model=self.model,
                 tokenizer=self.tokenizer,
                 task=self.batch_inference_job.task,
-                run_tests_str=run_tests_str,
-                run_metrics_str=run_metrics_str,
+                run_tests_path=run_tests_path,
+                run_metrics_path=run_metrics_path,
                 max_new_tokens=self.batch_inference_job.generator.max_seq_length or MAX_NEW_TOKENS,
             )
 
@@ -63,16 +68,15 @@ class BatchInferenceJobRunner:
         """Load the model from HuggingFace Hub or S3."""
         use_4bit = self.batch_inference_job.quantized or False
         if use_4bit:
-            # Compute dtype for 4-bit base models
-            bnb_4bit_compute_dtype = "float16"
+            # Compute dtype for 4-bit base models, bfloat16 on GPUs that support it (Ampere and newer)
+            major, _ = torch.cuda.get_device_capability()
+            compute_dtype = torch.bfloat16 if major >= 8 else torch.float16
             # Quantization type (fp4 or nf4)
             bnb_4bit_quant_type = "nf4"
             # Activate nested quantization for 4-bit base models (double quantization)
-            use_nested_quant = False
+            use_nested_quant = True
 
             # Load tokenizer and model with QLoRA configuration
-            compute_dtype = getattr(torch, bnb_4bit_compute_dtype)
-
             bnb_config = BitsAndBytesConfig(
                 load_in_4bit=use_4bit,
                 bnb_4bit_quant_type=bnb_4bit_quant_type,
@@ -80,14 +84,6 @@ class BatchInferenceJobRunner:
                 bnb_4bit_use_double_quant=use_nested_quant,
             )
 
-            # Check GPU compatibility with bfloat16
-            if compute_dtype == torch.float16 and use_4bit:
-                major, _ = torch.cuda.get_device_capability()
-                if major >= 8:
-                    print("=" * 80)
-                    print("Your GPU supports bfloat16: accelerate training with bf16=True")
-                    print("=" * 80)
-
         if self.batch_inference_job.model.type == "huggingface":
             device_map = {"": 0}
 
@@ -97,6 +93,7 @@ class BatchInferenceJobRunner:
                     self.batch_inference_job.model.name,
                     quantization_config=bnb_config,
                     device_map=device_map,
+                    low_cpu_mem_usage=True,
                     trust_remote_code=True,
                 )
                 model.config.use_cache = False
@@ -108,6 +105,7 @@ class BatchInferenceJobRunner:
                     use_cache=False,
                     trust_remote_code=True,
                     device_map=device_map,
+                    low_cpu_mem_usage=True,
                 )
             tokenizer = AutoTokenizer.from_pretrained(
                 self.batch_inference_job.model.name,
@@ -116,13 +114,18 @@ class BatchInferenceJobRunner:
                 add_bos_token=False,
             )
             # May need to have some custom padding logic here
-            special_tokens = {"pad_token": "[PAD]"}
-            tokenizer.add_special_tokens(special_tokens)
+            num_added_tokens = 0
+            # Padding with EOS would mask the EOS labels too, and the model would never learn to stop
+            if tokenizer.pad_token is None or tokenizer.pad_token_id == tokenizer.eos_token_id:
+                special_tokens = {"pad_token": "[PAD]"}
+                num_added_tokens += tokenizer.add_special_tokens(special_tokens)
             if self.batch_inference_job.tokenizer and self.batch_inference_job.tokenizer.additional_tokens:
-                tokenizer.add_tokens(self.batch_inference_job.tokenizer.additional_tokens)
+                num_added_tokens += tokenizer.add_tokens(self.batch_inference_job.tokenizer.additional_tokens)
             tokenizer.padding_side = "right"
             model.config.pad_token_id = tokenizer.pad_token_id
-            model.resize_token_embeddings(len(tokenizer))
+            # Resizing allocates and copies the whole embedding matrix, so only do it for new tokens
+            if num_added_tokens > 0:
+                model.resize_token_embeddings(len(tokenizer))
         elif self.batch_inference_job.model.type == "s3":
             # TODO : Add s3 support
             raise NotImplementedError("S3 support not implemented yet")
@@ -136,15 +139,12 @@ class BatchInferenceJobRunner:
         bos_token = self.tokenizer.bos_token
         eos_token = self.tokenizer.eos_token
         if self.batch_inference_job.dataset.type == "huggingface":
-            splits["batch_inference"] = Dataset.from_generator(
-                dataset_generator,
-                gen_kwargs={
-                    "dataset": self.batch_inference_job.dataset.name,
-                    "split": "batch_inference",
-                    "task": self.batch_inference_job.task,
-                    "bos_token": bos_token,
-                    "eos_token": eos_token,
-                },
+            splits["batch_inference"] = load_formatted_dataset(
+                dataset=self.batch_inference_job.dataset.name,
+                split="batch_inference",
+                task=self.batch_inference_job.task,
+                bos_token=bos_token,
+                eos_token=eos_token,
             )
         elif self.batch_inference_job.dataset.type == "s3":
             os.makedirs(DATASET_DIR)
@@ -160,58 +160,22 @@ class BatchInferenceJobRunner:
             )
             print(os.listdir(DATASET_DIR))
             print(os.listdir(f"{DATASET_DIR}/{local_name}"))
-            splits["batch_inference"] = Dataset.from_generator(
-                dataset_generator,
-                gen_kwargs={
-                    "dataset": f"{DATASET_DIR}/{local_name}",
-                    "split": "batch_inference",
-                    "from_disk": True,
-                    "task": self.batch_inference_job.task,
-                    "bos_token": bos_token,
-                    "eos_token": eos_token,
-                },
+            splits["batch_inference"] = load_formatted_dataset(
+                dataset=f"{DATASET_DIR}/{local_name}",
+                split="batch_inference",
+                from_disk=True,
+                task=self.batch_inference_job.task,
+                bos_token=bos_token,
+                eos_token=eos_token,
             )
         elif self.batch_inference_job.dataset.type == "local":
             print("Loading dataset locally: ", os.listdir(self.batch_inference_job.dataset.path))
-            splits["train"] = Dataset.from_generator(
-                dataset_generator,
-                gen_kwargs={
-                    "dataset": self.batch_inference_job.dataset.path,
-                    "split": "train",
-                    "from_disk": True,
-                    "task": self.batch_inference_job.task,
-                    "bos_token": bos_token,
-                    "eos_token": eos_token,
-                },
+            splits = format_dataset_dict(
+                load_from_disk(self.batch_inference_job.dataset.path),
+                task=self.batch_inference_job.task,
+                bos_token=bos_token,
+                eos_token=eos_token,
             )
-            try:
-                splits["val"] = Dataset.from_generator(
-                    dataset_generator,
-                    gen_kwargs={
-                        "dataset": self.batch_inference_job.dataset.path,
-                        "split": "val",
-                        "from_disk": True,
-                        "task": self.batch_inference_job.task,
-                        "bos_token": bos_token,
-                        "eos_token": eos_token,
-                    },
-                )
-            except:  # pylint: disable=bare-except  # noqa: E722
-                print("Unable to create val dataset")
-            try:
-                splits["test"] = Dataset.from_generator(
-                    dataset_generator,
-                    gen_kwargs={
-                        "dataset": self.batch_inference_job.dataset.path,
-                        "split": "test",
-                        "from_disk": True,
-                        "task": self.batch_inference_job.task,
-                        "bos_token": bos_token,
-                        "eos_token": eos_token,
-                    },
-                )
-            except:  # pylint: disable=bare-except  # noqa: E722
-                print("Unable to create test dataset")
         else:
             raise ValueError(f"Unknown dataset_type: {self.batch_inference_job.dataset.type}")
 
@@ -268,76 +232,85 @@ class BatchInferenceWithEval:
         model: AutoModelForCausalLM,
         tokenizer: AutoTokenizer,
         task: str,
-        run_tests_str: str = "",
-        run_metrics_str: str = "",
+        run_tests_path: str = "",
+        run_metrics_path: str = "",
         max_new_tokens: int = MAX_NEW_TOKENS,
         batch_size: int = 8,
     ):
         """Initialize the batch inference class."""
-        self.gen_config = GenerationConfig.from_pretrained(model.name_or_path, max_new_tokens=max_new_tokens)
+        self.gen_config = GenerationConfig.from_pretrained(
+            model.name_or_path, max_new_tokens=max_new_tokens, use_cache=True
+        )
         self.model = model
         self.tokenizer = tokenizer
         self.task = task
-        self.run_tests_str = run_tests_str
-        if run_tests_str and os.environ.get("ALLOW_CUSTOM_TESTS", "false").lower() == "true":
-            exec(self.run_tests_str, globals())
-        else:
-            self.run_tests_str = ""
-        self.run_metrics_str = run_metrics_str
-        if run_metrics_str and os.environ.get("ALLOW_CUSTOM_METRICS", "false").lower() == "true":
-            exec(self.run_metrics_str, globals())
-        else:
-            self.run_metrics_str = ""
+        self.batch_size = batch_size
+        # Custom tests and metrics are imported once from "package.module:function" paths
+        self._run_tests: Optional[Callable[..., Any]] = None
+        if run_tests_path and os.environ.get("ALLOW_CUSTOM_TESTS", "false").lower() == "true":
+            self._run_tests = load_callable(run_tests_path)
+        self._run_metrics: Optional[Callable[..., Any]] = None
+        if run_metrics_path and os.environ.get("ALLOW_CUSTOM_METRICS", "false").lower() == "true":
+            self._run_metrics = load_callable(run_metrics_path)
         self.initial_predictions: list[str] = []
 
     def generate(self, prompt: str) -> Any:
         """Generate a completion from a prompt."""
-        tokenized_prompt = self.tokenizer(prompt, return_tensors="pt", padding=True)["input_ids"].cuda()
-        with torch.inference_mode():
-            output = self.model.generate(
-                inputs=tokenized_prompt, generation_config=self.gen_config, pad_token_id=self.tokenizer.eos_token_id
-            )
-        return self.tokenizer.decode(output[0][len(tokenized_prompt[0]) :], skip_special_tokens=True)
+        return self.generate_batch([prompt])[0]
+
+    def generate_batch(self, prompts: list[str]) -> list[str]:
+        """Generate completions for a batch of prompts in a single call to the model."""
+        # Pad on the left so that generation continues right after the end of every prompt
+        padding_side = self.tokenizer.padding_side
+        self.tokenizer.padding_side = "left"
+        try:
+            inputs = self.tokenizer(prompts, return_tensors="pt", padding=True).to("cuda")
+        finally:
+            self.tokenizer.padding_side = padding_side
+        # The KV cache is disabled on the model config for training, re-enable it while decoding
+        use_cache = self.model.config.use_cache
+        self.model.config.use_cache = True
+        try:
+            with torch.inference_mode():
+                output = self.model.generate(
+                    **inputs, generation_config=self.gen_config, pad_token_id=self.tokenizer.pad_token_id
+                )
+        finally:
+            self.model.config.use_cache = use_cache
+        return self.tokenizer.batch_decode(output[:, inputs["input_ids"].shape[1] :], skip_special_tokens=True)
+
+    def generate_in_batches(self, prompts: list[str]) -> list[str]:
+        """Generate completions for all prompts, batch_size prompts at a time."""
+        predictions: list[str] = []
+        for start in tqdm(range(0, len(prompts), self.batch_size), leave=False):
+            predictions.extend(self.generate_batch(prompts[start : start + self.batch_size]))
+        return predictions
+
+    def prompts_and_actuals(self, rows: Dataset) -> Tuple[list[str], list[str]]:
+        """Extract the prompt and completion columns once, prefixing each prompt with the BOS token."""
+        bos_token = self.tokenizer.bos_token
+        prompts = rows["text"] if self.task == "text" else rows["prompt"]
+        prompts = [prompt if prompt.startswith(bos_token) else f"{bos_token}{prompt}" for prompt in prompts]
+        return prompts, rows["completion"]
 
     def run_initial_predictions(self, rows: Dataset) -> Tuple[list[dict[str, Any]], Tuple[Table, dict[str, Any]]]:
         """Generate initial predictions for the sample split."""
-        # Test the provided code if present:
-        print("Testing custom code, on ground truth if provided")
-        test_rows = []
-        for example in tqdm(rows, leave=False):
-            prompt = example["prompt"]
-            actual = example["completion"]
-            test_rows.append({"prompt": prompt, "actual": actual, "predicted": actual, "initial": actual})
-        self.execute_custom_code(test_rows)
-
         print("Generating initial predictions for sample split")
-        predicted_rows = []
-        for example in tqdm(rows, leave=False):
-            if self.task == "text":
-                prompt = example["text"]
-            else:
-                prompt = example["prompt"]
-            if not prompt.startswith(self.tokenizer.bos_token):
-                prompt = f"{self.tokenizer.bos_token}{prompt}"
-            predicted = self.generate(prompt=prompt)
-            self.initial_predictions.append(predicted)
-            actual = example["completion"]
-            predicted_rows.append({"prompt": prompt, "actual": actual, "predicted": predicted, "initial": predicted})
+        prompts, actuals = self.prompts_and_actuals(rows)
+        self.initial_predictions = self.generate_in_batches(prompts)
+        predicted_rows = [
+            {"prompt": prompt, "actual": actual, "predicted": predicted, "initial": predicted}
+            for prompt, actual, predicted in zip(prompts, actuals, self.initial_predictions)
+        ]
         return predicted_rows, self.execute_custom_code(predicted_rows)
 
     def infer(self, rows: Dataset) -> Tuple[list[dict[str, Any]], Tuple[Table, dict[str, Any]]]:
         """Generate batch predictions."""
         print("Generating predictions for sample split")
+        prompts, actuals = self.prompts_and_actuals(rows)
+        predictions = self.generate_in_batches(prompts)
         predicted_rows = []
-        for i, example in tqdm(enumerate(rows), leave=False):
-            if self.task == "text":
-                prompt = example["text"]
-            else:
-                prompt = example["prompt"]
-            actual = example["completion"]
-            if not prompt.startswith(self.tokenizer.bos_token):
-                prompt = f"{self.tokenizer.bos_token}{prompt}"
-            predicted = self.generate(prompt=prompt)
+        for i, (prompt, actual, predicted) in enumerate(zip(prompts, actuals, predictions)):
             row_obj = {"prompt": prompt, "actual": actual, "predicted": predicted}
             if self.initial_predictions:
                 row_obj["initial"] = self.initial_predictions[i]
@@ -348,24 +321,20 @@ class BatchInferenceWithEval:
         """Execute custom code for tests and metrics."""
         records_table = Table(columns=["prompt", "predicted", "actual", "initial", "test_result", "errors"])
 
-        # Assuming run_tests_str and run_metrics_str contain your testing and metrics code respectively
-
         print("Updating records_table with predictions, test results, and errors")
-        if self.run_tests_str and os.environ.get("ALLOW_CUSTOM_TESTS", "false").lower() == "true":
-            # Execute dynamic code for tests
+        if self._run_tests:
             print("Running custom tests")
-            tests, errors = run_tests([row["prompt"] for row in rows], [row["predicted"] for row in rows])  # type: ignore  # noqa: F821
+            tests, errors = self._run_tests([row["prompt"] for row in rows], [row["predicted"] for row in rows])
         else:
             print("Skipping custom tests")
             tests, errors = [False] * len(rows), [""] * len(rows)
 
-        if self.run_metrics_str and os.environ.get("ALLOW_CUSTOM_METRICS", "false").lower() == "true":
-            # Execute dynamic code for metrics
+        if self._run_metrics:
             print("Running custom metrics")
             pts = [row["prompt"] for row in rows]
             acts = [row["actual"] for row in rows]
             prds = [row["predicted"] for row in rows]
-            metrics = run_metrics(pts, acts, prds)  # type: ignore  # noqa: F821
+            metrics = self._run_metrics(pts, acts, prds)
         else:
             print("Skipping custom metrics")
             metrics = {}
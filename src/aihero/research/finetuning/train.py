@@ -1,12 +1,13 @@
 """Launch the training job inside a container."""
 import os
+import shutil
 import time
 import traceback
 from typing import Any, Tuple
 
 import torch
-from datasets import Dataset, DatasetDict
-from huggingface_hub import login
+from datasets import DatasetDict, load_from_disk
+from huggingface_hub import HfApi, login
 from peft import LoraConfig, get_peft_model
 from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, TrainingArguments
 from trl import SFTTrainer
@@ -14,10 +15,21 @@ from wandb import finish
 
 from aihero.research.config.schema import TrainingJob
 from aihero.research.finetuning.callback import LLMSampleCB
-from aihero.research.finetuning.utils import DatasetMover, dataset_generator, peft_module_casting_to_bf16
+from aihero.research.finetuning.utils import (
+    DatasetMover,
+    dataset_num_proc,
+    find_all_linear_names,
+    format_dataset_dict,
+    hash_config,
+    load_formatted_dataset,
+    load_streaming_dataset,
+    peft_module_casting_to_bf16,
+)
 
 CHECKPOINT_DIR = "/mnt/checkpoint"
 DATASET_DIR = "/mnt/dataset"
+# Non-reentrant checkpointing works with DDP and does not need inputs that require grads
+GRADIENT_CHECKPOINTING_KWARGS = {"use_reentrant": False}
 
 if os.environ.get("HF_TOKEN", None):
     print("Logging in to HuggingFace Hub")
@@ -50,16 +62,15 @@ class TrainingJobRunner:
         """Load the model from HuggingFace Hub or S3."""
         use_4bit = self.training_job.quantized or False
         if use_4bit:
-            # Compute dtype for 4-bit base models
-            bnb_4bit_compute_dtype = "float16"
+            # Compute dtype for 4-bit base models, bfloat16 on GPUs that support it (Ampere and newer)
+            major, _ = torch.cuda.get_device_capability()
+            compute_dtype = torch.bfloat16 if major >= 8 else torch.float16
             # Quantization type (fp4 or nf4)
             bnb_4bit_quant_type = "nf4"
             # Activate nested quantization for 4-bit base models (double quantization)
-            use_nested_quant = False
+            use_nested_quant = True
 
             # Load tokenizer and model with QLoRA configuration
-            compute_dtype = getattr(torch, bnb_4bit_compute_dtype)
-
             bnb_config = BitsAndBytesConfig(
                 load_in_4bit=use_4bit,
                 bnb_4bit_quant_type=bnb_4bit_quant_type,
@@ -67,14 +78,6 @@ class TrainingJobRunner:
                 bnb_4bit_use_double_quant=use_nested_quant,
             )
 
-            # Check GPU compatibility with bfloat16
-            if compute_dtype == torch.float16 and use_4bit:
-                major, _ = torch.cuda.get_device_capability()
-                if major >= 8:
-                    print("=" * 80)
-                    print("Your GPU supports bfloat16: accelerate training with bf16=True")
-                    print("=" * 80)
-
         device_map = {"": self.local_rank if self.is_distributed else 0}
         print("Device map: ", device_map)
 
@@ -85,6 +88,7 @@ class TrainingJobRunner:
                     self.training_job.base.name,
                     quantization_config=bnb_config,
                     device_map=device_map,
+                    low_cpu_mem_usage=True,
                     trust_remote_code=True,
                 )
                 model.config.use_cache = False
@@ -96,6 +100,7 @@ class TrainingJobRunner:
                     use_cache=False,
                     trust_remote_code=True,
                     device_map=device_map,
+                    low_cpu_mem_usage=True,
                 )
             tokenizer = AutoTokenizer.from_pretrained(
                 self.training_job.base.name,
@@ -104,13 +109,18 @@ class TrainingJobRunner:
                 add_bos_token=False,
             )
             # May need to have some custom padding logic here
-            special_tokens = {"pad_token": "[PAD]"}
-            tokenizer.add_special_tokens(special_tokens)
+            num_added_tokens = 0
+            # Padding with EOS would mask the EOS labels too, and the model would never learn to stop
+            if tokenizer.pad_token is None or tokenizer.pad_token_id == tokenizer.eos_token_id:
+                special_tokens = {"pad_token": "[PAD]"}
+                num_added_tokens += tokenizer.add_special_tokens(special_tokens)
             if self.training_job.tokenizer and self.training_job.tokenizer.additional_tokens:
-                tokenizer.add_tokens(self.training_job.tokenizer.additional_tokens)
+                num_added_tokens += tokenizer.add_tokens(self.training_job.tokenizer.additional_tokens)
             tokenizer.padding_side = "right"
             model.config.pad_token_id = tokenizer.pad_token_id
-            model.resize_token_embeddings(len(tokenizer))
+            # Resizing allocates and copies the whole embedding matrix, so only do it for new tokens
+            if num_added_tokens > 0:
+                model.resize_token_embeddings(len(tokenizer))
 
         elif self.training_job.base.type == "s3":
             # TODO : Add s3 support
@@ -144,46 +154,24 @@ class TrainingJobRunner:
                 f.write("Downloading Data")
         print(f"LOCAL RANK {self.local_rank}: loading data")
         try:
-            splits = {}
             bos_token = self.tokenizer.bos_token
             eos_token = self.tokenizer.eos_token
+            # Stream the train split from the hub instead of downloading the full dataset up front
+            streaming = (
+                self.training_job.dataset.type == "huggingface"
+                and os.environ.get("DATASET_STREAMING", "false").lower() == "true"
+            )
+            if streaming:
+                assert not self.training_job.trainer.packing, "Packing is not supported for streaming datasets"
+            # Resolve the source data first, so that the cache key reflects its contents and not just its name
+            source = None
+            source_dataset_dict = None
             if self.training_job.dataset.type == "huggingface":
-                splits["train"] = Dataset.from_generator(
-                    dataset_generator,
-                    gen_kwargs={
-                        "dataset": self.training_job.dataset.name,
-                        "split": "train",
-                        "task": self.training_job.task,
-                        "bos_token": bos_token,
-                        "eos_token": eos_token,
-                    },
-                )
-                try:
-                    splits["val"] = Dataset.from_generator(
-                        dataset_generator,
-                        gen_kwargs={
-                            "dataset": self.training_job.dataset.name,
-                            "split": "val",
-                            "task": self.training_job.task,
-                            "bos_token": bos_token,
-                            "eos_token": eos_token,
-                        },
-                    )
-                except:  # pylint: disable=bare-except  # noqa: E722
-                    print("Unable to create val dataset")
                 try:
-                    splits["test"] = Dataset.from_generator(
-                        dataset_generator,
-                        gen_kwargs={
-                            "dataset": self.training_job.dataset.name,
-                            "split": "test",
-                            "task": self.training_job.task,
-                            "bos_token": bos_token,
-                            "eos_token": eos_token,
-                        },
-                    )
+                    # The resolved revision changes whenever the dataset is updated on the hub
+                    source = HfApi().dataset_info(self.training_job.dataset.name).sha
                 except:  # pylint: disable=bare-except  # noqa: E722
-                    print("Unable to create test dataset")
+                    print("Unable to resolve the dataset revision, the formatted dataset will not be cached")
             elif self.training_job.dataset.type == "s3":
                 dataset_mover = DatasetMover()
                 # If the dataset is s3, download it to the local directory
@@ -198,92 +186,103 @@ class TrainingJobRunner:
                     )
                 print(os.listdir(DATASET_DIR))
                 print(os.listdir(f"{DATASET_DIR}/{local_name}"))
-                splits["train"] = Dataset.from_generator(
-                    dataset_generator,
-                    gen_kwargs={
-                        "dataset": f"{DATASET_DIR}/{local_name}",
-                        "split": "train",
-                        "from_disk": True,
-                        "task": self.training_job.task,
-                        "bos_token": bos_token,
-                        "eos_token": eos_token,
-                    },
-                )
-                try:
-                    splits["val"] = Dataset.from_generator(
-                        dataset_generator,
-                        gen_kwargs={
-                            "dataset": f"{DATASET_DIR}/{local_name}",
-                            "split": "val",
-                            "from_disk": True,
-                            "task": self.training_job.task,
-                            "bos_token": bos_token,
-                            "eos_token": eos_token,
-                        },
-                    )
-                except:  # pylint: disable=bare-except  # noqa: E722
-                    print("Unable to create val dataset")
-                try:
-                    splits["test"] = Dataset.from_generator(
-                        dataset_generator,
-                        gen_kwargs={
-                            "dataset": f"{DATASET_DIR}/{local_name}",
-                            "split": "test",
-                            "from_disk": True,
-                            "task": self.training_job.task,
-                            "bos_token": bos_token,
-                            "eos_token": eos_token,
-                        },
-                    )
-                except:  # pylint: disable=bare-except  # noqa: E722
-                    print("Unable to create test dataset")
-
+                source_dataset_dict = load_from_disk(f"{DATASET_DIR}/{local_name}")
             elif self.training_job.dataset.type == "local":
                 print("Loading dataset locally: ", os.listdir(self.training_job.dataset.path))
-                splits["train"] = Dataset.from_generator(
-                    dataset_generator,
-                    gen_kwargs={
-                        "dataset": self.training_job.dataset.path,
-                        "split": "train",
-                        "from_disk": True,
-                        "task": self.training_job.task,
-                        "bos_token": bos_token,
-                        "eos_token": eos_token,
-                    },
-                )
-                try:
-                    splits["val"] = Dataset.from_generator(
-                        dataset_generator,
-                        gen_kwargs={
-                            "dataset": self.training_job.dataset.path,
-                            "split": "val",
-                            "from_disk": True,
-                            "task": self.training_job.task,
-                            "bos_token": bos_token,
-                            "eos_token": eos_token,
-                        },
-                    )
-                except:  # pylint: disable=bare-except  # noqa: E722
-                    print("Unable to create val dataset")
-                try:
-                    splits["test"] = Dataset.from_generator(
-                        dataset_generator,
-                        gen_kwargs={
-                            "dataset": self.training_job.dataset.path,
-                            "split": "test",
-                            "from_disk": True,
-                            "task": self.training_job.task,
-                            "bos_token": bos_token,
-                            "eos_token": eos_token,
-                        },
+                source_dataset_dict = load_from_disk(self.training_job.dataset.path)
+            if source_dataset_dict is not None:
+                # Fingerprints change whenever a dataset is regenerated and saved again
+                source = {split: ds._fingerprint for split, ds in source_dataset_dict.items()}
+
+            # Formatted splits are cached on disk under one directory per dataset, keyed by the source data and
+            # everything that affects the formatting, so that older versions of the same dataset can be pruned
+            dataset_key = hash_config(
+                {
+                    "type": self.training_job.dataset.type,
+                    "name": self.training_job.dataset.name,
+                    "path": self.training_job.dataset.path,
+                }
+            )
+            source_key = hash_config(
+                {"source": source, "task": self.training_job.task, "bos_token": bos_token, "eos_token": eos_token}
+            )
+            cache_dir = f"{DATASET_DIR}/_formatted/{dataset_key}"
+            cache_path = f"{cache_dir}/{source_key}"
+            use_cache = source is not None and not streaming
+            # Only rank 0 rebuilds, the other ranks wait for it and then load the fresh cache
+            rebuild_cache = (
+                self.local_rank == 0 and os.environ.get("REBUILD_DATASET_CACHE", "false").lower() == "true"
+            )
+            if use_cache and not rebuild_cache and os.path.exists(cache_path):
+                print(f"LOCAL RANK {self.local_rank}: loading formatted dataset from {cache_path}")
+                dataset_dict = load_from_disk(cache_path)
+            else:
+                splits = {}
+                if self.training_job.dataset.type == "huggingface":
+                    if streaming:
+                        splits["train"] = load_streaming_dataset(
+                            dataset=self.training_job.dataset.name,
+                            tokenizer=self.tokenizer,
+                            max_seq_length=self.training_job.trainer.max_seq_length,
+                            split="train",
+                            task=self.training_job.task,
+                            bos_token=bos_token,
+                            eos_token=eos_token,
+                        )
+                    else:
+                        splits["train"] = load_formatted_dataset(
+                            dataset=self.training_job.dataset.name,
+                            split="train",
+                            task=self.training_job.task,
+                            bos_token=bos_token,
+                            eos_token=eos_token,
+                        )
+                    try:
+                        splits["val"] = load_formatted_dataset(
+                            dataset=self.training_job.dataset.name,
+                            split="val",
+                            task=self.training_job.task,
+                            bos_token=bos_token,
+                            eos_token=eos_token,
+                            streaming=streaming,
+                        )
+                    except:  # pylint: disable=bare-except  # noqa: E722
+                        print("Unable to create val dataset")
+                    try:
+                        splits["test"] = load_formatted_dataset(
+                            dataset=self.training_job.dataset.name,
+                            split="test",
+                            task=self.training_job.task,
+                            bos_token=bos_token,
+                            eos_token=eos_token,
+                            streaming=streaming,
+                        )
+                    except:  # pylint: disable=bare-except  # noqa: E722
+                        print("Unable to create test dataset")
+                else:
+                    splits = format_dataset_dict(
+                        source_dataset_dict,
+                        task=self.training_job.task,
+                        bos_token=bos_token,
+                        eos_token=eos_token,
                     )
-                except:  # pylint: disable=bare-except  # noqa: E722
-                    print("Unable to create test dataset")
+
+                dataset_dict = DatasetDict(splits)
+                if self.local_rank == 0 and use_cache:
+                    # Save to a temporary path first so that a partial write is never picked up as a cache hit
+                    shutil.rmtree(f"{cache_path}.tmp", ignore_errors=True)
+                    dataset_dict.save_to_disk(f"{cache_path}.tmp")
+                    shutil.rmtree(cache_path, ignore_errors=True)
+                    os.rename(f"{cache_path}.tmp", cache_path)
+                    # Drop the formatted copies of older versions of this dataset
+                    for entry in os.listdir(cache_dir):
+                        if entry != source_key:
+                            shutil.rmtree(f"{cache_dir}/{entry}", ignore_errors=True)
 
             print(f"LOCAL RANK {self.local_rank}: data loaded")
             if os.path.exists(f"{DATASET_DIR}/downloading_data.txt"):
                 os.remove(f"{DATASET_DIR}/downloading_data.txt")
-            return DatasetDict(splits)
+            return dataset_dict
         except:  # pylint: disable=bare-except  # noqa: E722
             traceback.print_exc()
             if os.path.exists(f"{DATASET_DIR}/downloading_data.txt"):
@@ -357,14 +356,22 @@ class TrainingJobRunner:
 
         # SFT training config
         training_arguments_dict = self.training_job.sft.model_dump()
-        training_arguments_dict["save_total_limit"] = 2
-        training_arguments_dict["save_strategy"] = self.training_job.sft.evaluation_strategy
-        training_arguments_dict["load_best_model_at_end"] = True
         training_arguments_dict["output_dir"] = CHECKPOINT_DIR
+        if training_arguments_dict.get("gradient_checkpointing") is None:
+            # Gradient checkpointing is on unless the job config turns it off
+            training_arguments_dict["gradient_checkpointing"] = True
+        training_arguments_dict["gradient_checkpointing_kwargs"] = GRADIENT_CHECKPOINTING_KWARGS
+        if self.training_job.quantized and training_arguments_dict.get("optim") in (None, "adamw_torch"):
+            # QLoRA relies on paged 8-bit optimizer states to absorb memory spikes
+            training_arguments_dict["optim"] = "paged_adamw_8bit"
         training_arguments = TrainingArguments(**training_arguments_dict)
         # PEFT training config
         if self.training_job.peft:
-            lora_config = LoraConfig(**self.training_job.peft.model_dump())
+            lora_config_dict = self.training_job.peft.model_dump()
+            if self.training_job.quantized and not lora_config_dict.get("target_modules"):
+                # QLoRA needs adapters on every linear layer to match 16-bit fine-tuning
+                lora_config_dict["target_modules"] = find_all_linear_names(self.model)
+            lora_config = LoraConfig(**lora_config_dict)
             model = get_peft_model(self.model, lora_config)
             if self.training_job.sft.bf16:
                 peft_module_casting_to_bf16(model, self.training_job.peft.model_dump())
@@ -384,18 +391,19 @@ class TrainingJobRunner:
             dataset_text_field="text",
             max_seq_length=self.training_job.trainer.max_seq_length,
             packing=self.training_job.trainer.packing,  # Should you combine multiple examples into one sequence?
+            dataset_num_proc=dataset_num_proc(),  # Tokenize the splits once, in parallel, before training
             args=training_arguments,
         )
 
         task = self.training_job.dataset.task
         if self.training_job.eval and self.training_job.eval.tests:
-            run_tests_str = self.training_job.eval.tests
+            run_tests_path = self.training_job.eval.tests
         else:
-            run_tests_str = ""
+            run_tests_path = ""
         if self.training_job.eval and self.training_job.eval.metrics:
-            run_metrics_str = self.training_job.eval.metrics
+            run_metrics_path = self.training_job.eval.metrics
         else:
-            run_metrics_str = ""
+            run_metrics_path = ""
         if test_split and test_split.num_rows > 0 and task == "completion":
             if os.environ.get("WANDB_API_KEY", None):
                 # we instantiate the W&B callback with the trainer object and the dataset we want to sample from
@@ -405,8 +413,8 @@ class TrainingJobRunner:
                     test_split,
                     num_samples=test_split.num_rows if test_split.num_rows < 100 else 100,
                     max_new_tokens=self.training_job.trainer.max_seq_length,
-                    run_tests_str=run_tests_str,
-                    run_metrics_str=run_metrics_str,
+                    run_tests_path=run_tests_path,
+                    run_metrics_path=run_metrics_path,
                 )
                 wandb_callback.initialize()
                 trainer.add_callback(wandb_callback)
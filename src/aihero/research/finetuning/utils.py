@@ -1,13 +1,17 @@
 """Utility functions for the app. e.g. upload and download files from S3."""
+import hashlib
+import importlib
+import json
 import os
 import tarfile
-from typing import Any, Generator
+import tempfile
+from typing import Any, Callable
 
 import torch
-from datasets import load_dataset, load_from_disk
+from datasets import Dataset, DatasetDict, IterableDataset, load_dataset, load_from_disk
 from minio import Minio, S3Error
 from peft.tuners.lora import LoraLayer
-from transformers import AutoModelForCausalLM
+from transformers import AutoModelForCausalLM, PreTrainedTokenizerBase
 
 
 class DatasetMover:
@@ -39,8 +43,8 @@ class DatasetMover:
         self._compress_folder(folder_path, output_filename)
         self._upload_to_s3(output_filename, bucket_name, output_filename)
 
-    def _download_from_s3(self, bucket_name: str, object_name: str, file_name: str) -> None:
-        """Download a file from S3."""
+    def _download_and_decompress_from_s3(self, bucket_name: str, object_name: str, output_folder_path: str) -> None:
+        """Stream a tar.gz file from S3 and decompress it into a folder while it downloads."""
         try:
             # Initialize MinIO client
             minio_client = Minio(
@@ -50,65 +54,162 @@ class DatasetMover:
                 region=os.environ["S3_REGION"],
                 secure=os.environ.get("S3_SECURE", "True").lower() == "true",
             )
-            minio_client.fget_object(bucket_name, object_name, file_name)
-            print(f"'{object_name}' from bucket '{bucket_name}' is successfully downloaded as '{file_name}'.")
+            response = minio_client.get_object(bucket_name, object_name)
+            try:
+                # Extract next to the destination and move into place only once the whole tarball is read,
+                # so a failed download never leaves a partial dataset behind
+                with tempfile.TemporaryDirectory(dir=output_folder_path) as temp_dir:
+                    # The "r|gz" stream mode never seeks, so the tarball is extracted as it arrives
+                    with tarfile.open(fileobj=response, mode="r|gz") as tar:
+                        tar.extractall(path=temp_dir)
+                    for name in os.listdir(temp_dir):
+                        os.rename(os.path.join(temp_dir, name), os.path.join(output_folder_path, name))
+            finally:
+                response.close()
+                response.release_conn()
+            print(
+                f"'{object_name}' from bucket '{bucket_name}' is successfully downloaded and decompressed "
+                f"to '{output_folder_path}'."
+            )
         except S3Error as e:
             print("Error occurred: ", e)
 
-    def _decompress_folder(self, input_filename: str, output_folder_path: str) -> None:
-        """Decompress a tar.gz file into a folder."""
-        try:
-            with tarfile.open(input_filename, "r:gz") as tar:
-                tar.extractall(path=output_folder_path)
-            print(f"'{input_filename}' is successfully decompressed to '{output_folder_path}'.")
-        except Exception as e:
-            print("Error occurred: ", e)
-
     def download(self, bucket_name: str, object_name: str, output_folder_path: str) -> None:
         """Download a tar.gz file from S3 and decompress it into a folder."""
-        temp_filename = "temp.tar.gz"
-        self._download_from_s3(bucket_name, object_name, temp_filename)
-        self._decompress_folder(temp_filename, output_folder_path)
-        os.remove(temp_filename)  # Clean up the temporary compressed file
+        self._download_and_decompress_from_s3(bucket_name, object_name, output_folder_path)
+
+
+def hash_config(config: dict[str, Any]) -> str:
+    """Hash a JSON-serializable dict into a short, stable cache key."""
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def load_callable(path: str) -> Callable[..., Any]:
+    """Import a callable from a "package.module:function" path."""
+    module_name, _, function_name = path.strip().rpartition(":")
+    if not all(part.isidentifier() for part in module_name.split(".")) or not function_name.isidentifier():
+        raise ValueError(
+            f"Expected a 'package.module:function' path, got {path!r}. "
+            "Inline source code for custom tests and metrics is no longer supported."
+        )
+    return getattr(importlib.import_module(module_name), function_name)  # type: ignore
+
+
+def dataset_num_proc() -> int:
+    """Return the number of worker processes for dataset maps, sharing the CPUs between ranks on this node."""
+    # Every rank runs its own maps at the same time, one process per GPU
+    return max(1, (os.cpu_count() or 1) // int(os.getenv("WORLD_SIZE", 1)))
+
+
+def format_batch(
+    batch: dict[str, list[Any]],
+    task: str = "text",
+    bos_token: str = "<s>",
+    eos_token: str = "</s>",
+) -> dict[str, list[str]]:
+    """Format a batch of rows into training text wrapped with the BOS and EOS tokens."""
+    if task == "text":
+        texts = [f"{text}" for text in batch["text"]]
+    elif task == "completion":
+        # If the dataset is a 'completion' task dataset, we need to concatenate the prompt and completion
+        texts = [f"{prompt}{completion}" for prompt, completion in zip(batch["prompt"], batch["completion"])]
+    else:
+        raise Exception(f"Unknown task: {task}")
+    texts = [text if text.startswith(bos_token) else f"{bos_token}{text}{eos_token}" for text in texts]
+    if task == "completion":
+        return {"text": texts, "prompt": batch["prompt"], "completion": batch["completion"]}
+    return {"text": texts}
+
+
+def format_dataset(
+    ds: Dataset,
+    task: str = "text",
+    bos_token: str = "<s>",
+    eos_token: str = "</s>",
+) -> Dataset:
+    """Format every row of the dataset split with a batched, multi-process map."""
+    return ds.map(
+        format_batch,
+        batched=True,
+        batch_size=1000,
+        num_proc=dataset_num_proc(),
+        remove_columns=ds.column_names,
+        fn_kwargs={"task": task, "bos_token": bos_token, "eos_token": eos_token},
+    )
 
 
-def dataset_generator(
+def load_formatted_dataset(
     dataset: str,
     split: str = "train",
     from_disk: bool = False,
     task: str = "text",
     bos_token: str = "<s>",
     eos_token: str = "</s>",
-) -> Generator[dict[str, Any], dict[str, Any], None]:
-    """Generate training data by yielding each row in the dataset split."""
+    streaming: bool = False,
+) -> Dataset:
+    """Load a dataset split and format it for training."""
     # We assume that the dataset is a HuggingFace dataset, and a DatasetDict
     # such that the dict has train, val, and test splits.
     if from_disk:
-        ds = load_from_disk(dataset)
-        ds = ds[split]
-        # Iterate through the dataset and yield each row
+        ds = load_from_disk(dataset)[split]
         print(f"{ds.num_rows} rows in {split} split")
+    elif streaming:
+        # Only this split is read, instead of downloading and preparing every split of the dataset.
+        # Meant for small splits, since all of its rows are held in memory.
+        ds = Dataset.from_list(list(load_dataset(dataset, split=split, streaming=True)))
     else:
-        ds = load_dataset(dataset, streaming=True, split=split)
-
-    for row in iter(ds):
-        if task == "text":
-            text = f"{row['text']}"
-            if not text.startswith(bos_token):
-                text = f"{bos_token}{text}{eos_token}"
-            yield {"text": text}
-        elif task == "completion":
-            # If the dataset is a 'completion' task dataset, we need to concatenate the prompt and completion
-            text = f"{row['prompt']}{row['completion']}"
-            if not text.startswith(bos_token):
-                text = f"{bos_token}{text}{eos_token}"
-            yield {
-                "text": text,
-                "prompt": row["prompt"],
-                "completion": row["completion"],
-            }
-        else:
-            raise Exception(f"Unknown task: {task}")
+        ds = load_dataset(dataset, split=split)
+    return format_dataset(ds, task=task, bos_token=bos_token, eos_token=eos_token)
+
+
+def tokenize_batch(
+    batch: dict[str, list[Any]],
+    tokenizer: PreTrainedTokenizerBase,
+    max_seq_length: int,
+) -> dict[str, list[list[int]]]:
+    """Tokenize the formatted text of a batch of rows."""
+    outputs = tokenizer(batch["text"], truncation=True, padding=False, max_length=max_seq_length)
+    return {"input_ids": outputs["input_ids"], "attention_mask": outputs["attention_mask"]}
+
+
+def load_streaming_dataset(
+    dataset: str,
+    tokenizer: PreTrainedTokenizerBase,
+    max_seq_length: int,
+    split: str = "train",
+    task: str = "text",
+    bos_token: str = "<s>",
+    eos_token: str = "</s>",
+) -> IterableDataset:
+    """Stream a dataset split from the hub, formatting and tokenizing rows as they are read."""
+    # The trainer uses iterable datasets as they are, so rows need to be tokenized here
+    ds = load_dataset(dataset, split=split, streaming=True)
+    ds = ds.map(format_batch, batched=True, fn_kwargs={"task": task, "bos_token": bos_token, "eos_token": eos_token})
+    ds = ds.map(
+        tokenize_batch,
+        batched=True,
+        fn_kwargs={"tokenizer": tokenizer, "max_seq_length": max_seq_length},
+    )
+    # Drop the text and source columns, the collator only handles token ids
+    return ds.select_columns(["input_ids", "attention_mask"])
+
+
+def format_dataset_dict(
+    dataset_dict: DatasetDict,
+    task: str = "text",
+    bos_token: str = "<s>",
+    eos_token: str = "</s>",
+) -> dict[str, Dataset]:
+    """Format the train, val and test splits of a DatasetDict loaded from disk."""
+    splits = {}
+    for split in ["train", "val", "test"]:
+        # Only the train split is required
+        if split != "train" and split not in dataset_dict:
+            print(f"Unable to create {split} dataset")
+            continue
+        print(f"{dataset_dict[split].num_rows} rows in {split} split")
+        splits[split] = format_dataset(dataset_dict[split], task=task, bos_token=bos_token, eos_token=eos_token)
+    return splits
 
 
 def peft_module_casting_to_bf16(model: AutoModelForCausalLM, args: dict[str, str]) -> None:
@@ -123,3 +224,15 @@ def peft_module_casting_to_bf16(model: AutoModelForCausalLM, args: dict[str, str
             if hasattr(module, "weight"):
                 if args["bf16"] and module.weight.dtype == torch.float32:
                     module = module.to(torch.bfloat16)
+
+
+def find_all_linear_names(model: AutoModelForCausalLM) -> list[str]:
+    """Find the names of all linear layers in the model, except the output head, for LoRA to target."""
+    # The head is matched by identity, since it is not always called lm_head (e.g. embed_out, output)
+    output_embeddings = model.get_output_embeddings()
+    names = set()
+    for name, module in model.named_modules():
+        # bitsandbytes' Linear4bit and Linear8bitLt are subclasses of torch.nn.Linear
+        if isinstance(module, torch.nn.Linear) and module is not output_embeddings:
+            names.add(name.split(".")[-1])
+    return sorted(names)